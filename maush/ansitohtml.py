@@ -13,16 +13,48 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>
+from functools import lru_cache
+from typing import Any
 import html
 
 from stransi import Ansi, SetAttribute, SetColor
 from stransi.attribute import Attribute
 from stransi.color import ColorRole
-from ochre import Color, RGB
+from ochre import Color
 from attr import dataclass
 
 
-@dataclass
+# The fields each SGR attribute sets, looked up by update_attribute
+ATTRIBUTE_UPDATES: dict[Attribute, tuple[tuple[str, Any], ...]] = {
+    Attribute.NORMAL: (
+        ("fg", None),
+        ("bg", None),
+        ("bold", False),
+        ("dim", False),
+        ("italic", False),
+        ("underline", False),
+        ("blink", False),
+        ("hidden", False),
+    ),
+    Attribute.BOLD: (("bold", True), ("dim", False)),
+    Attribute.DIM: (("dim", True), ("bold", False)),
+    Attribute.NEITHER_BOLD_NOR_DIM: (("bold", False), ("dim", False)),
+    Attribute.ITALIC: (("italic", True),),
+    Attribute.NOT_ITALIC: (("italic", False),),
+    Attribute.UNDERLINE: (("underline", True),),
+    Attribute.NOT_UNDERLINE: (("underline", False),),
+    Attribute.STRIKETHROUGH: (("strikethrough", True),),
+    Attribute.NOT_STRIKETHROUGH: (("strikethrough", False),),
+    Attribute.BLINK: (("blink", True),),
+    Attribute.NOT_BLINK: (("blink", False),),
+    Attribute.REVERSE: (("reverse", True),),
+    Attribute.NOT_REVERSE: (("reverse", False),),
+    Attribute.HIDDEN: (("hidden", True),),
+    Attribute.NOT_HIDDEN: (("hidden", False),),
+}
+
+
+@dataclass(slots=True)
 class ANSIHTML:
     fg: Color | None = None
     bg: Color | None = None
@@ -35,122 +67,134 @@ class ANSIHTML:
     reverse: bool = False
     hidden: bool = False
 
-    @property
-    def is_default(self) -> bool:
-        return not any([self.fg, self.bg, self.bold, self.dim, self.italic, self.underline, self.strikethrough, self.blink, self.reverse, self.hidden])
-
     def update_attribute(self, attr: Attribute) -> None:
-        if attr == Attribute.NORMAL:
-            self.fg = None
-            self.bg = None
-            self.bold = False
-            self.dim = False
-            self.italic = False
-            self.underline = False
-            self.blink = False
-            self.hidden = False
-        elif attr == Attribute.BOLD:
-            self.bold = True
-            self.dim = False
-        elif attr == Attribute.DIM:
-            self.dim = True
-            self.bold = False
-        elif attr == Attribute.NEITHER_BOLD_NOR_DIM:
-            self.bold = False
-            self.dim = False
-        elif attr == Attribute.ITALIC:
-            self.italic = True
-        elif attr == Attribute.NOT_ITALIC:
-            self.italic = False
-        elif attr == Attribute.UNDERLINE:
-            self.underline = True
-        elif attr == Attribute.NOT_UNDERLINE:
-            self.underline = False
-        elif attr == Attribute.STRIKETHROUGH:
-            self.strikethrough = True
-        elif attr == Attribute.NOT_STRIKETHROUGH:
-            self.strikethrough = False
-        elif attr == Attribute.BLINK:
-            self.blink = True
-        elif attr == Attribute.NOT_BLINK:
-            self.blink = False
-        elif attr == Attribute.REVERSE:
-            self.reverse = True
-        elif attr == Attribute.NOT_REVERSE:
-            self.reverse = False
-        elif attr == Attribute.HIDDEN:
-            self.hidden = True
-        elif attr == Attribute.NOT_HIDDEN:
-            self.hidden = False
+        for field, value in ATTRIBUTE_UPDATES.get(attr, ()):
+            setattr(self, field, value)
 
+    # The whole style packed into an int, which is zero for the default style
     @property
-    def open_tags(self) -> str:
-        tags = []
-        if self.hidden:
-            tags.append("<span data-mx-spoiler>")
-        if self.fg or self.bg:
-            fg, bg = self.fg, self.bg
-            if self.reverse:
-                if not fg:
-                    fg = RGB(0, 0, 0)
-                if not bg:
-                    bg = RGB(255, 255, 255)
-                fg, bg = bg, fg
-            tags.append("<font")
-            if fg:
-                tags.append(f' color="{fg.hex}"')
-            if bg:
-                tags.append(f' data-mx-bg-color="{bg.hex}"')
-            tags.append(">")
-        if self.bold:
-            tags.append("<strong>")
-        if self.italic:
-            tags.append("<em>")
-        if self.strikethrough:
-            tags.append("<del>")
-        if self.underline:
-            tags.append("<u>")
-        return "".join(tags)
+    def state(self) -> int:
+        return (
+            self.bold << BOLD_BIT
+            | self.dim << DIM_BIT
+            | self.italic << ITALIC_BIT
+            | self.underline << UNDERLINE_BIT
+            | self.strikethrough << STRIKETHROUGH_BIT
+            | self.blink << BLINK_BIT
+            | self.reverse << REVERSE_BIT
+            | self.hidden << HIDDEN_BIT
+            | _pack_color(self.fg) << FG_SHIFT
+            | _pack_color(self.bg) << BG_SHIFT
+        )
 
-    @property
-    def close_tags(self) -> str:
-        tags = []
-        if self.underline:
-            tags.append("</u>")
-        if self.strikethrough:
-            tags.append("</del>")
-        if self.italic:
-            tags.append("</em>")
-        if self.bold:
-            tags.append("</strong>")
-        if self.fg or self.bg:
-            tags.append("</font>")
-        if self.hidden:
-            tags.append("</span data-mx-spoiler>")
-        return "".join(tags)
+
+BOLD_BIT = 0
+DIM_BIT = 1
+ITALIC_BIT = 2
+UNDERLINE_BIT = 3
+STRIKETHROUGH_BIT = 4
+BLINK_BIT = 5
+REVERSE_BIT = 6
+HIDDEN_BIT = 7
+# Colors are stored as 24-bit RGB plus one, so that zero can mean "no color"
+FG_SHIFT = 8
+BG_SHIFT = FG_SHIFT + 25
+COLOR_MASK = (1 << 25) - 1
+
+BLACK = 0x000000
+WHITE = 0xFFFFFF
+
+
+def _pack_color(color: Color | None) -> int:
+    return 0 if color is None else color.hex.hex_code + 1
+
+
+@lru_cache(maxsize=1024)
+def _render_tags(state: int) -> tuple[str, str]:
+    open_tags = []
+    close_tags = []
+    if state & (1 << HIDDEN_BIT):
+        open_tags.append("<span data-mx-spoiler>")
+        close_tags.append("</span>")
+    fg = ((state >> FG_SHIFT) & COLOR_MASK) - 1
+    bg = ((state >> BG_SHIFT) & COLOR_MASK) - 1
+    if fg >= 0 or bg >= 0:
+        if state & (1 << REVERSE_BIT):
+            if fg < 0:
+                fg = BLACK
+            if bg < 0:
+                bg = WHITE
+            fg, bg = bg, fg
+        font = ["<font"]
+        if fg >= 0:
+            font.append(f' color="#{fg:06x}"')
+        if bg >= 0:
+            font.append(f' data-mx-bg-color="#{bg:06x}"')
+        font.append(">")
+        open_tags.append("".join(font))
+        close_tags.append("</font>")
+    if state & (1 << BOLD_BIT):
+        open_tags.append("<strong>")
+        close_tags.append("</strong>")
+    if state & (1 << ITALIC_BIT):
+        open_tags.append("<em>")
+        close_tags.append("</em>")
+    if state & (1 << STRIKETHROUGH_BIT):
+        open_tags.append("<del>")
+        close_tags.append("</del>")
+    if state & (1 << UNDERLINE_BIT):
+        open_tags.append("<u>")
+        close_tags.append("</u>")
+    return "".join(open_tags), "".join(reversed(close_tags))
 
 
 def _ansi_to_html(text: str) -> str:
     output = []
     tags = ANSIHTML()
+    # The packed state is only recomputed for the first text chunk after a style change
+    state: int | None = 0
+    # Consecutive text chunks with the same style are escaped and wrapped in tags together
+    pending = []
+    pending_state = 0
+
+    def flush() -> None:
+        if not pending:
+            return
+        escaped = html.escape("".join(pending))
+        if pending_state:
+            open_tags, close_tags = _render_tags(pending_state)
+            output.append(open_tags)
+            output.append(escaped)
+            output.append(close_tags)
+        else:
+            output.append(escaped)
+        pending.clear()
+
     for instruction in Ansi(text).instructions():
         if isinstance(instruction, str):
-            if not tags.is_default:
-                output.append(tags.open_tags)
-            output.append(html.escape(instruction))
-            if not tags.is_default:
-                output.append(tags.close_tags)
+            if state is None:
+                state = tags.state
+            if state != pending_state:
+                flush()
+                pending_state = state
+            pending.append(instruction)
         elif isinstance(instruction, SetColor):
             if instruction.role == ColorRole.FOREGROUND:
                 tags.fg = instruction.color
             elif instruction.role == ColorRole.BACKGROUND:
                 tags.bg = instruction.color
+            state = None
         elif isinstance(instruction, SetAttribute):
             tags.update_attribute(instruction.attribute)
+            state = None
+    flush()
     return "".join(output)
 
 
 def ansi_to_html(text: str) -> str:
+    if "\x1b" not in text:
+        # Plain output doesn't need to go through the ANSI parser at all
+        return html.escape(text)
     try:
         return _ansi_to_html(text)
     except Exception:
@@ -0,0 +1,63 @@
+# maushbot - A maubot to execute shell commands in maush from Matrix.
+# Copyright (C) 2023 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+
+from collections import OrderedDict
+from collections.abc import Iterator, MutableMapping
+from typing import TypeVar
+import time
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class LRUCache(MutableMapping[K, V]):
+    """A size-bounded mapping that evicts the least recently used entries first.
+
+    If ``ttl`` is set, entries also expire that many seconds after they were written.
+    """
+
+    maxsize: int
+    ttl: float | None
+    _data: OrderedDict[K, tuple[V, float]]
+
+    def __init__(self, maxsize: int, ttl: float | None = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl or None
+        self._data = OrderedDict()
+
+    def __getitem__(self, key: K) -> V:
+        value, expires_at = self._data[key]
+        if self.ttl and expires_at < time.monotonic():
+            del self._data[key]
+            raise KeyError(key)
+        self._data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key: K, value: V) -> None:
+        self._data[key] = (value, time.monotonic() + self.ttl if self.ttl else 0)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __delitem__(self, key: K) -> None:
+        del self._data[key]
+
+    def __iter__(self) -> Iterator[K]:
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -15,15 +15,21 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 
+from functools import lru_cache
 from typing import Any
+import asyncio
 import base64
 import json
+import logging
 import re
 import shlex
 
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
 from maubot import MessageEvent, Plugin
 from maubot.handlers import command, event
+from mautrix.client import Client
 from mautrix.types import (
+    ContentURI,
     EventType,
     FileInfo,
     MediaMessageEventContent,
@@ -32,6 +38,7 @@ from mautrix.types import (
     RoomNameStateEventContent,
     RoomTopicStateEventContent,
     ReactionEvent,
+    SpecVersions,
     StateEvent,
     UserID,
     EventID,
@@ -39,6 +46,32 @@ from mautrix.types import (
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 
 from .ansitohtml import ansi_to_html
+from .cache import LRUCache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+if orjson:
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+elif ujson:
+
+    def json_dumps(data: Any) -> bytes:
+        return ujson.dumps(data, ensure_ascii=False).encode("utf-8")
+
+    json_loads = ujson.loads
+else:
+
+    def json_dumps(data: Any) -> bytes:
+        return json.dumps(data).encode("utf-8")
+
+    json_loads = json.loads
 
 
 class Config(BaseProxyConfig):
@@ -47,109 +80,293 @@ class Config(BaseProxyConfig):
         helper.copy("admins")
         helper.copy("server")
         helper.copy("untrusted")
+        helper.copy("cache_size")
+        helper.copy("cache_ttl")
 
 
 LINE_LIMIT = 256
 BYTE_LIMIT = 8192
 ELLIPSIS = "[…]"
-
+MAX_REPLY_FILE_SIZE = 8 * 1024 * 1024
+# Outputs longer than this are converted to HTML in a thread
+ANSI_OFFLOAD_THRESHOLD = 1024
+# Outputs can be deleted with a reaction until they fall out of this cache
+REDACT_CACHE_SIZE = 4096
+REDACT_TTL = 24 * 60 * 60
+# Payloads larger than this are encoded/decoded in a thread to avoid blocking the event loop
+OFFLOAD_THRESHOLD = 64 * 1024
+MAUSH_TIMEOUT = ClientTimeout(total=5 * 60)
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+mime_msgtypes = {
+    "image": MessageType.IMAGE,
+    "video": MessageType.VIDEO,
+    "audio": MessageType.AUDIO,
+}
 
 allowed_localpart_regex = re.compile(r"^[A-Za-z0-9._=+-]+$")
+multi_slash_regex = re.compile(r"//+")
+
+
+@lru_cache(maxsize=4096)
+def _parse_sender(sender: UserID) -> tuple[str, str, bool]:
+    localpart, server = Client.parse_user_id(sender)
+    return localpart, server, bool(allowed_localpart_regex.match(localpart))
+
+
+@lru_cache(maxsize=1024)
+def _compute_home(server: str, localpart: str) -> str:
+    return multi_slash_regex.sub("/", f"/{server}/{localpart}")
+
+
+def _encode_request(req_data: dict[str, Any], devices: dict[str, str | bytes]) -> bytes:
+    # The devices are spliced into the JSON as raw base64 bytes, so that large reply files
+    # don't get decoded into a str and then re-encoded by the JSON serializer.
+    if not devices:
+        return json_dumps({**req_data, "devices": {}})
+    parts = [json_dumps(req_data)[:-1], b', "devices": {']
+    for i, (name, file) in enumerate(devices.items()):
+        if i > 0:
+            parts.append(b", ")
+        parts.append(json_dumps(name))
+        parts.append(b': "')
+        parts.append(base64.b64encode(file.encode("utf-8") if isinstance(file, str) else file))
+        parts.append(b'"')
+    parts.append(b"}}")
+    return b"".join(parts)
+
+
+def _truncate_output(s: str) -> str:
+    s = s.strip()
+    # Find the LINE_LIMITth newline without splitting the whole output into a list. Newlines
+    # past BYTE_LIMIT don't matter, since the byte limit cut would remove them anyway.
+    idx = -1
+    for _ in range(LINE_LIMIT):
+        idx = s.find("\n", idx + 1, BYTE_LIMIT)
+        if idx == -1:
+            break
+    else:
+        if s.find("\n", idx + 1) != -1:
+            s = s[:idx] + "\n" + ELLIPSIS
+    if len(s) > BYTE_LIMIT:
+        s = s[: BYTE_LIMIT - len(ELLIPSIS)] + ELLIPSIS
+    return s
+
 
+def _summarize(value: Any) -> Any:
+    # Long strings like the base64 out_file would make for a multi-megabyte log line
+    if isinstance(value, dict):
+        return {key: _summarize(item) for key, item in value.items()}
+    elif isinstance(value, str) and len(value) > 256:
+        return f"<{len(value)} characters>"
+    return value
+
+
+async def _render_ansi(text: str) -> str:
+    if len(text) > ANSI_OFFLOAD_THRESHOLD:
+        return await asyncio.to_thread(ansi_to_html, text)
+    return ansi_to_html(text)
+
+
+class FileTooLarge(Exception):
+    pass
 
 
 class MaushBot(Plugin):
-    name_cache: dict[RoomID, str]
-    topic_cache: dict[RoomID, str]
-    allow_redact: set[EventID]
+    name_cache: LRUCache[RoomID, str] | None
+    topic_cache: LRUCache[RoomID, str] | None
+    allow_redact: LRUCache[EventID, bool]
+    rooms: frozenset[RoomID]
+    admins: frozenset[UserID]
+    untrusted: frozenset[UserID]
+    maush_http: ClientSession | None
+    maush_server: str | None
+    _close_tasks: set[asyncio.Task]
 
     @classmethod
     def get_config_class(cls) -> type[BaseProxyConfig]:
         return Config
 
     async def start(self) -> None:
-        self.name_cache = {}
-        self.topic_cache = {}
-        self.allow_redact = set()
+        self.allow_redact = LRUCache(REDACT_CACHE_SIZE, ttl=REDACT_TTL)
+        self.maush_http = None
+        self.maush_server = None
+        self._close_tasks = set()
+        self.name_cache = None
+        self.topic_cache = None
         self.on_external_config_update()
 
+    async def stop(self) -> None:
+        if self.maush_http:
+            await self.maush_http.close()
+            self.maush_http = None
+        # Cancelling makes the sessions of old servers close right away
+        for task in self._close_tasks:
+            task.cancel()
+        await asyncio.gather(*self._close_tasks, return_exceptions=True)
+
+    def on_external_config_update(self) -> None:
+        super().on_external_config_update()
+        self.rooms = frozenset(self.config["rooms"])
+        self.admins = frozenset(self.config["admins"])
+        self.untrusted = frozenset(self.config["untrusted"])
+        cache_size, cache_ttl = self.config["cache_size"], self.config["cache_ttl"] or None
+        if self.name_cache is None or (cache_size, cache_ttl) != (
+            self.name_cache.maxsize,
+            self.name_cache.ttl,
+        ):
+            self.name_cache = LRUCache(cache_size, ttl=cache_ttl)
+            self.topic_cache = LRUCache(cache_size, ttl=cache_ttl)
+        if self.maush_http and self.maush_server == self.config["server"]:
+            return
+        if self.maush_http:
+            # Connections to the old server are useless now, so don't keep them pooled
+            task = self.loop.create_task(self._close_later(self.maush_http))
+            self._close_tasks.add(task)
+            task.add_done_callback(self._close_tasks.discard)
+        self.maush_server = self.config["server"]
+        self.maush_http = ClientSession(
+            connector=TCPConnector(
+                limit=32, limit_per_host=16, keepalive_timeout=75, ttl_dns_cache=300
+            ),
+            timeout=MAUSH_TIMEOUT,
+        )
+
+    @staticmethod
+    async def _close_later(http: ClientSession) -> None:
+        # Closing the session would abort requests that are still running on it, but none of
+        # them can take longer than the request timeout
+        try:
+            await asyncio.sleep(MAUSH_TIMEOUT.total)
+        finally:
+            await http.close()
+
     async def get_cached_name(self, room_id: RoomID) -> str:
-        if room_id not in self.name_cache:
-            name_evt = await self.client.get_state_event(room_id, EventType.ROOM_NAME)
-            self.name_cache[room_id] = (
-                name_evt.name.strip()
-                if (isinstance(name_evt, RoomNameStateEventContent) and name_evt.name)
-                else ""
-            )
-        return self.name_cache[room_id]
+        # The entry may be evicted or expire right after it's written, so don't read it back
+        try:
+            return self.name_cache[room_id]
+        except KeyError:
+            pass
+        name_evt = await self.client.get_state_event(room_id, EventType.ROOM_NAME)
+        name = (
+            name_evt.name.strip()
+            if (isinstance(name_evt, RoomNameStateEventContent) and name_evt.name)
+            else ""
+        )
+        self.name_cache[room_id] = name
+        return name
 
     async def get_cached_topic(self, room_id: RoomID) -> str:
-        if room_id not in self.topic_cache:
-            topic_evt = await self.client.get_state_event(room_id, EventType.ROOM_TOPIC)
-            self.topic_cache[room_id] = (
-                topic_evt.topic.strip()
-                if (isinstance(topic_evt, RoomTopicStateEventContent) and topic_evt.topic)
-                else ""
-            )
-        return self.topic_cache[room_id]
+        try:
+            return self.topic_cache[room_id]
+        except KeyError:
+            pass
+        topic_evt = await self.client.get_state_event(room_id, EventType.ROOM_TOPIC)
+        topic = (
+            topic_evt.topic.strip()
+            if (isinstance(topic_evt, RoomTopicStateEventContent) and topic_evt.topic)
+            else ""
+        )
+        self.topic_cache[room_id] = topic
+        return topic
+
+    async def _download_limited(self, mxc: ContentURI) -> bytearray:
+        # Same request as client.download_media, but streamed so that huge files can be rejected
+        authenticated = (await self.client.versions()).supports(SpecVersions.V111)
+        url = self.client.api.get_download_url(mxc, authenticated=authenticated)
+        params = {"allow_redirect": "true"}
+        headers = {}
+        if authenticated:
+            headers["Authorization"] = f"Bearer {self.client.api.token}"
+            if self.client.api.as_user_id:
+                params["user_id"] = self.client.api.as_user_id
+        async with self.client.api.session.get(url, params=params, headers=headers) as resp:
+            resp.raise_for_status()
+            try:
+                content_length = int(resp.headers.get("Content-Length", 0))
+            except ValueError:
+                # The streamed size check below still applies
+                content_length = 0
+            if content_length > MAX_REPLY_FILE_SIZE:
+                raise FileTooLarge()
+            buf = bytearray()
+            async for chunk in resp.content.iter_chunked(64 * 1024):
+                buf += chunk
+                if len(buf) > MAX_REPLY_FILE_SIZE:
+                    raise FileTooLarge()
+        return buf
+
+    async def _get_reply_device(self, evt: MessageEvent) -> str | bytearray | None:
+        reply_to_id = evt.content.get_reply_to()
+        if not reply_to_id:
+            return None
+        reply_to_evt = await self.client.get_event(evt.room_id, reply_to_id)
+        if reply_to_evt.content.msgtype.is_media:
+            return await self._download_limited(reply_to_evt.content.url)
+        return reply_to_evt.content.body
 
     async def _exec(self, evt: MessageEvent, **kwargs: Any) -> None:
         if not self._exec_ok(evt):
             self.log.debug(f"Ignoring exec {evt.event_id} from {evt.sender} in {evt.room_id}")
             return
 
-        http = self.client.api.session
-        old_name = await self.get_cached_name(evt.room_id)
-        old_topic = await self.get_cached_topic(evt.room_id)
+        try:
+            old_name, old_topic, reply = await asyncio.gather(
+                self.get_cached_name(evt.room_id),
+                self.get_cached_topic(evt.room_id),
+                self._get_reply_device(evt),
+            )
+        except FileTooLarge:
+            await evt.reply("File too large")
+            return
+        except ClientError:
+            self.log.exception("Failed to download reply file")
+            await evt.reply("Failed to download reply file")
+            return
         devices = {}
         if old_name:
             devices["name"] = old_name
         if old_topic:
             devices["topic"] = old_topic
-        reply_to_id = evt.content.get_reply_to()
-        if reply_to_id:
-            reply_to_evt = await self.client.get_event(evt.room_id, reply_to_id)
-            if reply_to_evt.content.msgtype.is_media:
-                url = self.client.api.get_download_url(reply_to_evt.content.url)
-                max_size = 8 * 1024 * 1024
-                async with self.client.api.session.head(url) as response:
-                    if int(response.headers["Content-Length"]) > max_size:
-                        await evt.reply("File too large")
-                        return
-                file = await self.client.download_media(reply_to_evt.content.url)
-                if len(file) > max_size:
-                    await evt.reply("File too large")
-                    return
-                devices["reply"] = file
-            else:
-                devices["reply"] = reply_to_evt.content.body
+        if reply is not None:
+            devices["reply"] = reply
 
-        localpart, server = self.client.parse_user_id(evt.sender)
-        if not allowed_localpart_regex.match(localpart):
+        localpart, server, allowed = _parse_sender(evt.sender)
+        if not allowed:
             await evt.reply("User ID not supported")
             return
         req_data = {
             **kwargs,
             "user": evt.sender,
-            "home": re.sub(r"//+", "/", f"/{server}/{localpart}"),
-            "untrusted": evt.sender in self.config["untrusted"],
-            "devices": {
-                name: base64.b64encode(
-                    file.encode("utf-8") if isinstance(file, str) else file
-                ).decode("utf-8")
-                for name, file in devices.items()
-            },
+            "home": _compute_home(server, localpart),
+            "untrusted": evt.sender in self.untrusted,
         }
+        if any(len(file) > OFFLOAD_THRESHOLD for file in devices.values()):
+            body = await asyncio.to_thread(_encode_request, req_data, devices)
+        else:
+            body = _encode_request(req_data, devices)
         try:
-            resp = await http.post(self.config["server"], data=json.dumps(req_data))
+            resp = await self.maush_http.post(self.maush_server, data=body, headers=JSON_HEADERS)
         except Exception:
             await evt.reply("Failed to send request to maush")
             return
-        if resp.status == 502:
-            await evt.reply("maush is currently down")
-            return
-        data = await resp.json()
-        self.log.debug("Execution response for %s: %s", evt.sender, data)
+        # Release the connection back to the pool even if the body isn't read
+        async with resp:
+            if resp.status == 502:
+                await evt.reply("maush is currently down")
+                return
+            try:
+                raw_data = await resp.read()
+            except Exception:
+                await evt.reply("Failed to send request to maush")
+                return
+        if len(raw_data) > OFFLOAD_THRESHOLD:
+            data = await asyncio.to_thread(json_loads, raw_data)
+        else:
+            data = json_loads(raw_data)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Execution response for %s: %s", evt.sender, _summarize(data))
         if not data["ok"]:
             self.log.error("Exec failed: %s", data["error"])
             await evt.reply(data["error"])
@@ -164,25 +381,23 @@ class MaushBot(Plugin):
         if data["timeout"]:
             resp += "**Execution timed out**. "
         if data["stdout"]:
-            stdout = data["stdout"].strip()
-            if stdout.count("\n") > LINE_LIMIT:
-                stdout = "\n".join(stdout.split("\n")[:LINE_LIMIT] + [ELLIPSIS])
-            if len(stdout) > BYTE_LIMIT:
-                stdout = stdout[: BYTE_LIMIT - len(ELLIPSIS)] + ELLIPSIS
-            resp += f"**stdout:**\n<pre><code>{ansi_to_html(stdout)}\n</code></pre>\n"
+            stdout = _truncate_output(data["stdout"])
+            resp += f"**stdout:**\n<pre><code>{await _render_ansi(stdout)}\n</code></pre>\n"
         if data["stderr"]:
-            stderr = data["stderr"].strip()
-            if stderr.count("\n") > LINE_LIMIT:
-                stderr = "\n".join(stderr.split("\n")[:LINE_LIMIT] + [ELLIPSIS])
-            if len(stderr) > BYTE_LIMIT:
-                stderr = stderr[: BYTE_LIMIT - len(ELLIPSIS)] + ELLIPSIS
-            resp += f"**stderr:**\n<pre><code>{ansi_to_html(stderr)}\n</code></pre>\n"
+            stderr = _truncate_output(data["stderr"])
+            resp += f"**stderr:**\n<pre><code>{await _render_ansi(stderr)}\n</code></pre>\n"
 
+        # The reaction, state updates and output file upload are independent of each other,
+        # so they're started as tasks right away and run concurrently. Using tasks rather than
+        # bare coroutines means an exception in between can't leave any of them unstarted.
+        pending = {}
         resp = resp.strip()
         if resp:
             evt_id = await evt.reply(resp, allow_html=True)
-            self.allow_redact.add(evt_id)
-            await self.client.react(evt.room_id, evt_id, "delete")
+            self.allow_redact[evt_id] = True
+            pending["react"] = asyncio.create_task(
+                self.client.react(evt.room_id, evt_id, "delete")
+            )
 
         new_dev = data["devices"]
         new_name = new_dev.get("name") or ""
@@ -192,41 +407,53 @@ class MaushBot(Plugin):
         if new_topic:
             new_topic = new_topic.strip()
         if (
-            evt.sender in self.config["untrusted"] or len(new_name) > 100 or len(new_topic) > 1000
+            evt.sender in self.untrusted or len(new_name) > 100 or len(new_topic) > 1000
         ) and (new_name != old_name or new_topic != old_topic):
-            await evt.reply("3:<")
+            pending["reply"] = asyncio.create_task(evt.reply("3:<"))
+            await self._gather_steps(evt, pending)
             return
+        out_file = data.get("out_file")
+        if out_file:
+            if len(out_file["content"]) > OFFLOAD_THRESHOLD:
+                data = await asyncio.to_thread(base64.b64decode, out_file["content"])
+            else:
+                data = base64.b64decode(out_file["content"])
+            mime = out_file["mimetype"]
+            filename = out_file["name"]
+            pending["upload"] = asyncio.create_task(
+                self.client.upload_media(
+                    data=data,
+                    filename=filename,
+                    mime_type=mime,
+                )
+            )
         if new_name != old_name:
-            await self.client.send_state_event(
-                evt.room_id,
-                EventType.ROOM_NAME,
-                RoomNameStateEventContent(name=new_name),
+            pending["name"] = asyncio.create_task(
+                self.client.send_state_event(
+                    evt.room_id,
+                    EventType.ROOM_NAME,
+                    RoomNameStateEventContent(name=new_name),
+                )
             )
-            self.name_cache[evt.room_id] = new_name
         if new_topic != old_topic:
-            await self.client.send_state_event(
-                evt.room_id,
-                EventType.ROOM_TOPIC,
-                RoomTopicStateEventContent(topic=new_topic),
+            pending["topic"] = asyncio.create_task(
+                self.client.send_state_event(
+                    evt.room_id,
+                    EventType.ROOM_TOPIC,
+                    RoomTopicStateEventContent(topic=new_topic),
+                )
             )
+        results = await self._gather_steps(evt, pending)
+        if "name" in results and not isinstance(results["name"], BaseException):
+            self.name_cache[evt.room_id] = new_name
+        if "topic" in results and not isinstance(results["topic"], BaseException):
             self.topic_cache[evt.room_id] = new_topic
-        out_file = data.get("out_file")
         if out_file:
-            data = base64.b64decode(out_file["content"])
-            mime = out_file["mimetype"]
-            filename = out_file["name"]
-            uri = await self.client.upload_media(
-                data=data,
-                filename=filename,
-                mime_type=mime,
-            )
-            msgtype = MessageType.FILE
-            if mime.startswith("image/"):
-                msgtype = MessageType.IMAGE
-            elif mime.startswith("video/"):
-                msgtype = MessageType.VIDEO
-            elif mime.startswith("audio/"):
-                msgtype = MessageType.AUDIO
+            uri = results["upload"]
+            if isinstance(uri, BaseException):
+                await evt.reply("Failed to upload output file")
+                return
+            msgtype = mime_msgtypes.get(mime.split("/", 1)[0], MessageType.FILE)
             evt_id = await evt.reply(
                 MediaMessageEventContent(
                     msgtype=msgtype,
@@ -238,32 +465,44 @@ class MaushBot(Plugin):
                     ),
                 )
             )
-            self.allow_redact.add(evt_id)
+            self.allow_redact[evt_id] = True
             await self.client.react(evt.room_id, evt_id, "delete")
 
+    async def _gather_steps(
+        self, evt: MessageEvent, pending: dict[str, asyncio.Task]
+    ) -> dict[str, Any]:
+        # One failing step (e.g. no permission to change the name) shouldn't undo the others
+        results = dict(
+            zip(pending, await asyncio.gather(*pending.values(), return_exceptions=True))
+        )
+        for step, result in results.items():
+            if isinstance(result, BaseException):
+                self.log.error("%s failed after exec %s", step, evt.event_id, exc_info=result)
+        return results
+
     def _exec_ok(self, evt: MessageEvent) -> bool:
         return (
-            evt.room_id in self.config["rooms"]
+            evt.sender != self.client.mxid
             and evt.content.msgtype == MessageType.TEXT
-            and evt.sender != self.client.mxid
+            and evt.room_id in self.rooms
         )
 
     @event.on(EventType.REACTION)
     async def reaction(self, evt: ReactionEvent) -> None:
         if evt.content.relates_to.event_id in self.allow_redact and evt.content.relates_to.key == "delete" and evt.sender != self.client.mxid:
-            self.allow_redact.remove(evt.content.relates_to.event_id)
+            del self.allow_redact[evt.content.relates_to.event_id]
             await self.client.redact(evt.room_id, evt.content.relates_to.event_id, f"Delete requested by {evt.sender}")
 
     @event.on(EventType.ROOM_MESSAGE)
     async def arbitrary_cmd(self, evt: MessageEvent) -> None:
-        if not self._exec_ok(evt) or (
-            not evt.content.body.startswith("!!") and not evt.content.body.startswith("!?")
-        ):
+        body = evt.content.body
+        prefix = body[:2]
+        if prefix not in ("!!", "!?") or not self._exec_ok(evt):
             return
-        split = evt.content.body.split("\n\n", 1)
+        split = body.split("\n\n", 1)
         stdin = split[1] if len(split) > 1 else ""
         split = split[0].split(" ", 1)
-        prefix, cmd = split[0][:2], split[0][2:]
+        cmd = split[0][2:]
         args = [cmd]
         if len(split) > 1:
             args += shlex.split(split[1]) if prefix == "!?" else split[1].split(" ")
@@ -272,7 +511,7 @@ class MaushBot(Plugin):
     @command.new("admin-sh", aliases=["su"])
     @command.argument("script", required=True, pass_raw=True)
     async def admin_shell(self, evt: MessageEvent, script: str) -> None:
-        if evt.sender not in self.config["admins"]:
+        if evt.sender not in self.admins:
             await evt.reply("You're not an admin 😾")
             return
         await self._exec(evt, language="sh", script=script, admin=True)
@@ -281,7 +520,7 @@ class MaushBot(Plugin):
     @command.argument("user_id", required=True)
     @command.argument("script", required=True, pass_raw=True)
     async def sudo(self, evt: MessageEvent, user_id: UserID, script: str) -> None:
-        if evt.sender not in self.config["admins"]:
+        if evt.sender not in self.admins:
             await evt.reply("You're not an admin 😾")
             return
         evt.sender = user_id
@@ -309,8 +548,13 @@ class MaushBot(Plugin):
 
     @event.on(EventType.ROOM_NAME)
     async def name_handler(self, evt: StateEvent) -> None:
-        self.name_cache[evt.room_id] = evt.content.name.strip() if evt.content.name else ""
+        name = evt.content.name.strip() if evt.content.name else ""
+        # Skip the write for echoes of state events the bot itself just sent
+        if self.name_cache.get(evt.room_id) != name:
+            self.name_cache[evt.room_id] = name
 
     @event.on(EventType.ROOM_TOPIC)
     async def topic_handler(self, evt: StateEvent) -> None:
-        self.topic_cache[evt.room_id] = evt.content.topic.strip() if evt.content.topic else ""
+        topic = evt.content.topic.strip() if evt.content.topic else ""
+        if self.topic_cache.get(evt.room_id) != topic:
+            self.topic_cache[evt.room_id] = topic
@@ -25,7 +25,4 @@ class ColorPair:
         l1 = self.foreground.relative_luminance
         l2 = self.background.relative_luminance
 
-        if l1 < l2:
-            l1, l2 = l2, l1
-
-        return (l1 + 0.05) / (l2 + 0.05)
+        return (max(l1, l2) + 0.05) / (min(l1, l2) + 0.05)
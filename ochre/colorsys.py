@@ -57,18 +57,9 @@ __all__ = [
 
 def rgb_to_xyz(r: float, g: float, b: float) -> tuple[float, float, float]:
     """Convert the color from RGB coordinates to CIEXYZ coordinates."""
-    if r > 0.04045:
-        r = ((r + 0.055) / 1.055) ** 2.4
-    else:
-        r = r / 12.92
-    if g > 0.04045:
-        g = ((g + 0.055) / 1.055) ** 2.4
-    else:
-        g = g / 12.92
-    if b > 0.04045:
-        b = ((b + 0.055) / 1.055) ** 2.4
-    else:
-        b = b / 12.92
+    r = _SRGB_TO_LINEAR.get(r) or _srgb_to_linear(r)
+    g = _SRGB_TO_LINEAR.get(g) or _srgb_to_linear(g)
+    b = _SRGB_TO_LINEAR.get(b) or _srgb_to_linear(b)
 
     x = 0.4124 * r + 0.3576 * g + 0.1805 * b
     y = 0.2126 * r + 0.7152 * g + 0.0722 * b
@@ -112,12 +103,74 @@ def rgb_to_luv(r: float, g: float, b: float) -> tuple[float, float, float]:
 
 def hcl_to_rgb(h: float, c: float, ell: float) -> tuple[float, float, float]:
     """Convert the color from HCL coordinates to RGB coordinates."""
-    return luv_to_rgb(*hcl_to_luv(h, c, ell))
+    # This is `hcl_to_luv`, `luv_to_xyz` and `xyz_to_rgb` inlined, to avoid the
+    # intermediate calls and tuples.
+    u = c * math.cos(h)
+    v = c * math.sin(h)
+
+    if ell == 0:
+        x = y = z = 0
+    else:
+        ell, u, v = 100 * ell, 100 * u, 100 * v
+        d = 13 * ell
+        u, v = u / d + REF_UV_D65_2[0], v / d + REF_UV_D65_2[1]
+
+        four_v = 4 * v
+        if ell > 8:
+            y = ((ell + 16) / 116) ** 3
+        else:
+            y = ell / KAPPA
+        x, z = 9 * y * u / four_v, y * (12 - 3 * u - 20 * v) / four_v
+
+    r = 3.2406254 * x - 1.537208 * y - 0.4986286 * z
+    g = -0.9689307 * x + 1.8757561 * y + 0.0415175 * z
+    b = 0.0557101 * x - 0.2040211 * y + 1.0569959 * z
+
+    if r > 0.0031308:
+        r = 1.055 * (r ** (1 / 2.4)) - 0.055
+    else:
+        r = 12.92 * r
+    if g > 0.0031308:
+        g = 1.055 * (g ** (1 / 2.4)) - 0.055
+    else:
+        g = 12.92 * g
+    if b > 0.0031308:
+        b = 1.055 * (b ** (1 / 2.4)) - 0.055
+    else:
+        b = 12.92 * b
+
+    return r, g, b
 
 
 def rgb_to_hcl(r: float, g: float, b: float) -> tuple[float, float, float]:
     """Convert the color from RGB coordinates to HCL coordinates."""
-    return luv_to_hcl(*rgb_to_luv(r, g, b))
+    # This is `rgb_to_xyz`, `xyz_to_luv` and `luv_to_hcl` inlined, to avoid the
+    # intermediate calls and tuples.
+    r = _SRGB_TO_LINEAR.get(r) or _srgb_to_linear(r)
+    g = _SRGB_TO_LINEAR.get(g) or _srgb_to_linear(g)
+    b = _SRGB_TO_LINEAR.get(b) or _srgb_to_linear(b)
+
+    x = 0.4124 * r + 0.3576 * g + 0.1805 * b
+    y = 0.2126 * r + 0.7152 * g + 0.0722 * b
+    z = 0.0193 * r + 0.1192 * g + 0.9505 * b
+
+    if x == y == 0:
+        u, v = 0, 0
+    else:
+        d = x + 15 * y + 3 * z
+        u, v = 4 * x / d, 9 * y / d
+
+    if y > EPSILON:
+        ell = 116 * y ** (1 / 3) - 16
+    else:
+        ell = KAPPA * y
+    u, v = 13 * ell * (u - REF_UV_D65_2[0]), 13 * ell * (v - REF_UV_D65_2[1])
+    ell, u, v = ell / 100, u / 100, v / 100
+
+    h = math.atan2(v, u)
+    c = math.hypot(v, u)
+    h = h + math.tau if h < 0 else h
+    return h, c, ell
 
 
 def xyz_to_luv(x: float, y: float, z: float) -> tuple[float, float, float]:
@@ -207,6 +260,13 @@ def hex_to_hex(hc: int | Text) -> int:
     return hc
 
 
+def _srgb_to_linear(v: float) -> float:
+    """Undo the sRGB gamma correction of a single channel."""
+    if v > 0.04045:
+        return ((v + 0.055) / 1.055) ** 2.4
+    return v / 12.92
+
+
 def _xyz_to_uv(x: float, y: float, z: float) -> tuple[float, float]:
     """Convert the color from CIEXYZ coordinates to uv chromaticity coordinates."""
     if x == y == 0:
@@ -227,3 +287,12 @@ KAPPA = (29 / 3) ** 3
 
 REF_XYZ_D65_2 = 0.95047, 1.00000, 1.08883
 REF_UV_D65_2 = _xyz_to_uv(*REF_XYZ_D65_2)
+
+
+# Channels almost always come from 8-bit hex codes or from `RGB`, which rounds them to
+# two digits, so the gamma expansion of those values is looked up instead of computed.
+_SRGB8_TO_LINEAR = tuple(_srgb_to_linear(i / 255) for i in range(256))
+_SRGB_TO_LINEAR = {i / 255: v for i, v in enumerate(_SRGB8_TO_LINEAR)}
+_SRGB_TO_LINEAR.update(
+    (v, _srgb_to_linear(v)) for v in (round(i / 100, 2) for i in range(101))
+)
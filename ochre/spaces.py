@@ -5,6 +5,7 @@ import math
 import re
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Iterable, Iterator, Text, TypeVar, Union
 
 from . import ansi256, colorsys, web
@@ -13,7 +14,14 @@ C = TypeVar("C", bound="Color")
 
 
 class Color(ABC, Iterable[float]):
-    """Abstract base class for color spaces."""
+    """
+    Abstract base class for color spaces.
+
+    Colors are immutable, so conversions to other color spaces are cached on the
+    instance the first time they are computed.
+    """
+
+    __slots__ = ("_rgb", "_hex", "_hcl", "_index")
 
     @property
     @abstractmethod
@@ -43,17 +51,23 @@ class Color(ABC, Iterable[float]):
 
     def __index__(self) -> int:
         """Return the index of the color as an hexadecimal integer."""
-        return colorsys.hex_to_hex(self.hex.hex_code)
+        try:
+            return self._index
+        except AttributeError:
+            pass
+        index = colorsys.hex_to_hex(self.hex.hex_code)
+        object.__setattr__(self, "_index", index)
+        return index
 
     def __eq__(self, other: object) -> bool:
         """Return True if the colors are almost equal in RGB space."""
         if not isinstance(other, Color):
-            raise TypeError(f"{other!r} is not a Color")
-        return hex(self) == hex(other)
+            return NotImplemented
+        return self.__index__() == other.__index__()
 
     def __hash__(self) -> int:
         """Return the hash of the color."""
-        return hash(hex(self))
+        return self.__index__()
 
     def __iter__(self) -> Iterator[float]:
         """Return an iterator over the color's RGB channels."""
@@ -64,22 +78,48 @@ class Color(ABC, Iterable[float]):
 
     def distance(self, other: "Color") -> float:
         """Return the distance between colors in the HCL color space."""
+        return math.sqrt(self._distance_sq(other))
+
+    def _distance_sq(self, other: "Color") -> float:
+        """Return the squared distance between colors in the HCL color space."""
         self_hcl = self.hcl
         other_hcl = other.hcl
 
         # Hue wraps around at 360°, so we need to take the shortest distance.
-        hue_diff = abs(self_hcl.hue - other_hcl.hue)
-        hue_diff = min(hue_diff, 2 * math.pi - hue_diff)
-
-        return math.hypot(
-            hue_diff,
-            self_hcl.chroma - other_hcl.chroma,
-            self_hcl.luminance - other_hcl.luminance,
+        hue_diff = math.pi - abs(abs(self_hcl.hue - other_hcl.hue) - math.pi)
+        chroma_diff = self_hcl.chroma - other_hcl.chroma
+        luminance_diff = self_hcl.luminance - other_hcl.luminance
+
+        return (
+            hue_diff * hue_diff
+            + chroma_diff * chroma_diff
+            + luminance_diff * luminance_diff
         )
 
     def closest(self, colors: Iterable[C]) -> C:
         """Find the color in the given list that is closest to this color."""
-        return min(colors, key=self.distance)
+        # The square root doesn't change which color is the closest, so skip it.
+        return min(colors, key=self._distance_sq)
+
+    def _closest_hcl(self, palette: list[tuple[C, float, float, float]]) -> C:
+        """Find the closest color in a palette made by `_hcl_palette`."""
+        # Same as `self.closest(...)`, with the palette's HCL coordinates precomputed.
+        self_hcl = self.hcl
+        hue, chroma, luminance = self_hcl.hue, self_hcl.chroma, self_hcl.luminance
+        pi = math.pi
+        closest, closest_distance = None, math.inf
+        for color, other_hue, other_chroma, other_luminance in palette:
+            hue_diff = pi - abs(abs(hue - other_hue) - pi)
+            chroma_diff = chroma - other_chroma
+            luminance_diff = luminance - other_luminance
+            distance = (
+                hue_diff * hue_diff
+                + chroma_diff * chroma_diff
+                + luminance_diff * luminance_diff
+            )
+            if distance < closest_distance:
+                closest, closest_distance = color, distance
+        return closest
 
     def with_chroma(self, chroma: float) -> "HCL":
         """Return a copy of the color with the given chroma."""
@@ -104,17 +144,17 @@ class Color(ABC, Iterable[float]):
     @property
     def relative_luminance(self) -> float:
         """Return the relative luminance of the color as defined in WCAG 2.1."""
-
-        def f(v):
-            if v <= 0.03928:
-                return v / 12.92
-            return math.pow((v + 0.055) / 1.055, 2.4)
-
         self = self.rgb
-        return 0.2126 * f(self.red) + 0.7152 * f(self.green) + 0.0722 * f(self.blue)
+        red, green, blue = self.red, self.green, self.blue
+        get, f = _WCAG_LINEAR.get, _wcag_linear
+        return (
+            0.2126 * (get(red) or f(red))
+            + 0.7152 * (get(green) or f(green))
+            + 0.0722 * (get(blue) or f(blue))
+        )
 
 
-@dataclass(frozen=True, eq=False)
+@dataclass(frozen=True, eq=False, slots=True)
 class RGB(Color):
     """
     An RGB color.
@@ -130,9 +170,24 @@ class RGB(Color):
 
     def __post_init__(self) -> None:
         """Clamp and round RGB channels."""
-        object.__setattr__(self, "red", round(clip(self.red, 0, 1), self.N_DIGITS))
-        object.__setattr__(self, "green", round(clip(self.green, 0, 1), self.N_DIGITS))
-        object.__setattr__(self, "blue", round(clip(self.blue, 0, 1), self.N_DIGITS))
+        # Same as `clip(value, 0, 1)`, inlined since every RGB color goes through here.
+        red, green, blue = self.red, self.green, self.blue
+        n_digits = self.N_DIGITS
+        red = round(0 if red < 0 else 1 if red > 1 else red, n_digits)
+        green = round(0 if green < 0 else 1 if green > 1 else green, n_digits)
+        blue = round(0 if blue < 0 else 1 if blue > 1 else blue, n_digits)
+        object.__setattr__(self, "red", red)
+        object.__setattr__(self, "green", green)
+        object.__setattr__(self, "blue", blue)
+
+    @classmethod
+    def _raw(cls, red: float, green: float, blue: float) -> "RGB":
+        """Create an RGB color from channels that are already clamped and rounded."""
+        self = object.__new__(cls)
+        object.__setattr__(self, "red", red)
+        object.__setattr__(self, "green", green)
+        object.__setattr__(self, "blue", blue)
+        return self
 
     @property
     def rgb(self) -> "RGB":
@@ -142,25 +197,48 @@ class RGB(Color):
     @property
     def hex(self) -> "Hex":
         """Return the color as an Hex object."""
-        return Hex(colorsys.rgb_to_hex(self.red, self.green, self.blue))
+        try:
+            return self._hex
+        except AttributeError:
+            pass
+        self_hex = Hex(colorsys.rgb_to_hex(self.red, self.green, self.blue))
+        object.__setattr__(self, "_hex", self_hex)
+        return self_hex
+
+    def __index__(self) -> int:
+        """Return the index of the color as an hexadecimal integer."""
+        # Pack the channels directly instead of going through a Hex object.
+        try:
+            return self._index
+        except AttributeError:
+            pass
+        index = colorsys.rgb_to_hex(self.red, self.green, self.blue)
+        object.__setattr__(self, "_index", index)
+        return index
 
     @property
     def web_color(self) -> "WebColor":
         """Return the color as a WebColor object."""
-        return self.closest(map(WebColor, web.colors.keys()))
+        return self._closest_hcl(_WEB_PALETTE)
 
     @property
     def ansi256(self) -> "Ansi256":
         """Return the color as an Ansi256 object."""
-        return self.closest(map(Ansi256, range(len(ansi256.colors))))
+        return _rgb_to_ansi256(self.red, self.green, self.blue)
 
     @property
     def hcl(self) -> "HCL":
         """Return the color as an HCL object."""
-        return HCL(*colorsys.rgb_to_hcl(self.red, self.green, self.blue))
+        try:
+            return self._hcl
+        except AttributeError:
+            pass
+        self_hcl = HCL(*colorsys.rgb_to_hcl(self.red, self.green, self.blue))
+        object.__setattr__(self, "_hcl", self_hcl)
+        return self_hcl
 
 
-@dataclass(frozen=True, eq=False)
+@dataclass(frozen=True, eq=False, slots=True)
 class Hex(Color):
     """A color represented by a hexadecimal integer."""
 
@@ -169,20 +247,35 @@ class Hex(Color):
     def __repr__(self) -> Text:
         """Return a string representation of the color."""
         if isinstance(self.hex_code, int):
-            return f"Hex({self.hex_code:X})"
+            return "Hex(%X)" % self.hex_code
         return f"Hex({self.hex_code!r})"
 
     # meow change
     def __str__(self) -> str:
         if isinstance(self.hex_code, int):
-            return f"#{self.hex_code:06x}"
+            return "#%06x" % self.hex_code
         return f"#{self.hex_code}"
     # end meow change
 
     @property
     def rgb(self) -> RGB:
         """Return the color as an RGB object."""
-        return RGB(*colorsys.hex_to_rgb(self.hex_code))
+        try:
+            return self._rgb
+        except AttributeError:
+            pass
+        hc = colorsys.hex_to_hex(self.hex_code)
+        if 0 <= hc <= 0xFFFFFF:
+            self_rgb = RGB._raw(
+                _RGB8_CHANNELS[hc >> 16],
+                _RGB8_CHANNELS[(hc >> 8) & 0xFF],
+                _RGB8_CHANNELS[hc & 0xFF],
+            )
+        else:
+            # Out of range codes are clamped by the RGB constructor
+            self_rgb = RGB(*colorsys.hex_to_rgb(hc))
+        object.__setattr__(self, "_rgb", self_rgb)
+        return self_rgb
 
     @property
     def hex(self) -> "Hex":
@@ -190,7 +283,7 @@ class Hex(Color):
         return self
 
 
-@dataclass(frozen=True, eq=False)
+@dataclass(frozen=True, eq=False, slots=True)
 class WebColor(Color):
     """A color represented by a name."""
 
@@ -200,7 +293,9 @@ class WebColor(Color):
 
     def __post_init__(self) -> None:
         """Normalize the name of the color."""
-        norm_name = self.NORM_PATTERN.sub("", self.name).lower()
+        norm_name = self.name
+        if norm_name not in web.colors:
+            norm_name = _normalize_web_color_name(norm_name)
         if norm_name not in web.colors:
             raise ValueError(f"{norm_name!r} ({self.name!r}) is not a valid color name")
         object.__setattr__(self, "name", norm_name)
@@ -213,7 +308,13 @@ class WebColor(Color):
     @property
     def hex(self) -> Hex:
         """Return the color as an Hex object."""
-        return Hex(colorsys.web_color_to_hex(self.name))
+        try:
+            return self._hex
+        except AttributeError:
+            pass
+        self_hex = Hex(colorsys.web_color_to_hex(self.name))
+        object.__setattr__(self, "_hex", self_hex)
+        return self_hex
 
     @property
     def web_color(self) -> "WebColor":
@@ -221,7 +322,7 @@ class WebColor(Color):
         return self
 
 
-@dataclass(frozen=True, eq=False)
+@dataclass(frozen=True, eq=False, slots=True)
 class Ansi256(Color):
     """A color represented by an integer between 0 and 255."""
 
@@ -235,7 +336,13 @@ class Ansi256(Color):
     @property
     def hex(self) -> Hex:
         """Return the color as an Hex object."""
-        return Hex(colorsys.ansi256_to_hex(self.code))
+        try:
+            return self._hex
+        except AttributeError:
+            pass
+        self_hex = Hex(colorsys.ansi256_to_hex(self.code))
+        object.__setattr__(self, "_hex", self_hex)
+        return self_hex
 
     @property
     def ansi256(self) -> "Ansi256":
@@ -243,7 +350,7 @@ class Ansi256(Color):
         return self
 
 
-@dataclass(frozen=True, eq=False)
+@dataclass(frozen=True, eq=False, slots=True)
 class HCL(Color):
     """An HCL color."""
 
@@ -258,7 +365,13 @@ class HCL(Color):
     @property
     def rgb(self) -> RGB:
         """Return the color as an RGB object."""
-        return RGB(*colorsys.hcl_to_rgb(self.hue, self.chroma, self.luminance))
+        try:
+            return self._rgb
+        except AttributeError:
+            pass
+        self_rgb = RGB(*colorsys.hcl_to_rgb(self.hue, self.chroma, self.luminance))
+        object.__setattr__(self, "_rgb", self_rgb)
+        return self_rgb
 
     @property
     def hcl(self) -> "HCL":
@@ -273,3 +386,48 @@ def clip(value: float, min_value: float, max_value: float) -> float:
     if value > max_value:
         return max_value
     return value
+
+
+@lru_cache(maxsize=1024)
+def _normalize_web_color_name(name: Text) -> Text:
+    """Strip separators from a web color name and lowercase it."""
+    return WebColor.NORM_PATTERN.sub("", name).lower()
+
+
+# The rounded RGB channel for each 8-bit value, as `RGB.__post_init__` would store it.
+_RGB8_CHANNELS = tuple(round(i / 255, RGB.N_DIGITS) for i in range(256))
+
+
+def _wcag_linear(v: float) -> float:
+    """Linearize an RGB channel as defined in WCAG 2.1."""
+    if v <= 0.03928:
+        return v / 12.92
+    return math.pow((v + 0.055) / 1.055, 2.4)
+
+
+# Linearized values of every channel value an RGB color can hold after rounding.
+_WCAG_LINEAR = {
+    v: _wcag_linear(v)
+    for v in (
+        round(i / 10**RGB.N_DIGITS, RGB.N_DIGITS) for i in range(10**RGB.N_DIGITS + 1)
+    )
+}
+
+
+def _hcl_palette(colors: Iterable[C]) -> list[tuple[C, float, float, float]]:
+    """Pair colors with their HCL coordinates, for searching the closest color."""
+    palette = []
+    for color in colors:
+        hcl = color.hcl
+        palette.append((color, hcl.hue, hcl.chroma, hcl.luminance))
+    return palette
+
+
+_WEB_PALETTE = _hcl_palette(map(WebColor, web.colors))
+_ANSI256_PALETTE = _hcl_palette(map(Ansi256, range(len(ansi256.colors))))
+
+
+@lru_cache(maxsize=4096)
+def _rgb_to_ansi256(red: float, green: float, blue: float) -> Ansi256:
+    """Find the closest Ansi256 color to the given (rounded) RGB channels."""
+    return RGB._raw(red, green, blue)._closest_hcl(_ANSI256_PALETTE)